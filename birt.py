@@ -3,14 +3,18 @@ birt - Bulk Image Resizing Tool Module
 
 OVERVIEW
 Resize a group of images that reside in a specified directory PATH to be less than or equal to WIDTH, HEIGHT while
-maintaining the correct image orientation.
+maintaining the correct image orientation. Images that already fit within WIDTH, HEIGHT are saved at their own
+size rather than enlarged.
 
 By default the resized images will be placed in a sub-directory of PATH named 'resized'. Use the --subdir SUBDIR to
-change this default directory name.
+change this default directory name. With --recursive the images in the directories below PATH are resized too, into
+the same directory structure below SUBDIR.
 
 If a resized image save throws an exception, an attempt will be made to convert the image to JPG and save it again.
 This functionality was added when a .HEIC image could not be saved, but the converted JPG image could be saved.
 
+Only files whose extension is in IMAGE_EXTENSIONS are opened, other files are counted as not images.
+
 DEPENDENCIES
     Pillow (9.0.1) - manages image manipulation
 
@@ -24,14 +28,42 @@ LICENSE
     MIT (https://opensource.org/licenses/MIT)
 """
 # Python Standard Library
+import io
 import os
 import os.path
+import enum
 import logging
+import logging.handlers
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
 
 logr = logging.getLogger('birt').getChild(__name__)
 
+SEPARATOR = "=" * 80
+
 # 3rd Party Dependencies
-from PIL import Image
+from PIL import Image, JpegImagePlugin, UnidentifiedImageError
+
+# Resampling filters selectable for the resize, fastest first. LANCZOS (what Image.ANTIALIAS is an alias for) gives
+# the best quality, but BICUBIC is about twice as fast and visually identical for most down-sizing.
+FILTERS = {
+    'bilinear': Image.BILINEAR,
+    'hamming': Image.HAMMING,
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+}
+DEFAULT_FILTER = 'bicubic'
+
+# Options for saving the JPG of an image that could not be saved in its own format. Progressive JPGs are about the
+# same size but decode more gracefully, subsampling=2 is 4:2:0 chroma subsampling.
+JPEG_SAVE_OPTIONS = dict(quality=85, optimize=True, progressive=True, subsampling=2)
+
+# File extensions of the image formats to resize, anything else is counted as not an image without opening it
+IMAGE_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.heic', '.heif', '.webp', '.tif', '.tiff', '.bmp', '.gif',
+})
 
 
 def determine_resize(constraint_x, constraint_y, img_x, img_y):
@@ -45,6 +77,10 @@ def determine_resize(constraint_x, constraint_y, img_x, img_y):
     :param img_y: integer, image height
     :return: A tuple of integers of resized dimensions, (width, height)
     """
+    # Already within the constraints, keep the image's own size rather than enlarge it
+    if img_x <= constraint_x and img_y <= constraint_y:
+        return img_x, img_y
+
     new_y = int((constraint_x * img_y) / img_x)
     if new_y <= constraint_y:
         return constraint_x, new_y
@@ -56,7 +92,39 @@ def determine_resize(constraint_x, constraint_y, img_x, img_y):
             return constraint_x, constraint_y
 
 
-def reorient_image(im):
+# Transposes, in order, that display an image with the EXIF orientation correctly. Orientation 1 needs none.
+ORIENTATION_TRANSPOSES = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
+    6: (Image.ROTATE_270,),
+    7: (Image.ROTATE_270, Image.FLIP_TOP_BOTTOM),
+    8: (Image.ROTATE_90,),
+}
+
+# EXIF orientations that turn the image by 90 or 270 degrees, so swap its width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def get_orientation(im):
+    """
+    Read the camera orientation from the picture's EXIF metadata, see reorient_image().
+
+    :param im: PIL Image object
+    :return: integer, EXIF orientation 1 to 8, 1 when the image has no orientation
+    """
+    try:
+        # Stackoverflow indicates that the EXIF metadata is only available for JPG images...
+        # image_exif = im._getexif()
+        image_exif = im.getexif()  # PIL 6.2.2 offers a non-private method to use
+
+        return int(image_exif[274])
+    except (KeyError, AttributeError, TypeError, IndexError, ValueError):
+        return 1
+
+
+def reorient_image(im, image_orientation=None):
     """
     Explanation text mostly from: https://stackoverflow.com/a/4228725
 
@@ -70,41 +138,313 @@ def reorient_image(im):
     Without this function, pictures taken with a rotated camera do not have the correct orientation
     after being resized. So this function is necessary for a complete image resizing solution.
 
-    Code for this function lifted verbatim from: https://stackoverflow.com/a/48691518
+    The transposes for each orientation, see ORIENTATION_TRANSPOSES, are from: https://stackoverflow.com/a/48691518
 
     Also a complete set of test images that illustrate this orientation issue are available at:
     https://github.com/recurser/exif-orientation-examples
 
+    Transposing copies every pixel, so resize_images() reads the orientation with get_orientation() up front and
+    reorients the already resized image, which has far fewer pixels to copy.
+
     :param im: PIL Image object
+    :param image_orientation: integer, EXIF orientation of im, None reads it from im
     :return:  PIL Image object
     """
-    try:
-        # Stackoverflow indicates that the EXIF metadata is only available for JPG images...
-        # image_exif = im._getexif()
-        image_exif = im.getexif()  # PIL 6.2.2 offers a non-private method to use
+    if image_orientation is None:
+        image_orientation = get_orientation(im)
 
-        image_orientation = image_exif[274]
-        if image_orientation in (2, '2'):
-            return im.transpose(Image.FLIP_LEFT_RIGHT)
-        elif image_orientation in (3, '3'):
-            return im.transpose(Image.ROTATE_180)
-        elif image_orientation in (4, '4'):
-            return im.transpose(Image.FLIP_TOP_BOTTOM)
-        elif image_orientation in (5, '5'):
-            return im.transpose(Image.ROTATE_90).transpose(Image.FLIP_TOP_BOTTOM)
-        elif image_orientation in (6, '6'):
-            return im.transpose(Image.ROTATE_270)
-        elif image_orientation in (7, '7'):
-            return im.transpose(Image.ROTATE_270).transpose(Image.FLIP_TOP_BOTTOM)
-        elif image_orientation in (8, '8'):
-            return im.transpose(Image.ROTATE_90)
+    for method in ORIENTATION_TRANSPOSES.get(image_orientation, ()):
+        im = im.transpose(method)
+    return im
+
+
+class Status(enum.Enum):
+    """
+    Outcome of processing a single image file, as returned by process_image().
+    """
+    RESIZED = 'resized'
+    NOT_IMAGE = 'not image'
+    RESIZE_FAIL = 'resize fail'
+    SAVE_FAIL = 'save fail'
+
+
+def save_image(im, new_name, image_format=None, **options):
+    """
+    Save an image by encoding it into memory and then writing the file in one go, rather than in the many small
+    writes the encoders make. A failed save also no longer leaves a partly written file behind.
+
+    :param im: PIL Image object
+    :param new_name: str, file name to save the image to
+    :param image_format: str, PIL format name, None uses the format for the extension of new_name
+    :param options: extra keyword arguments for the image format's encoder
+    :return: None
+    """
+    if image_format is None:
+        ext = os.path.splitext(new_name)[1].lower()
+        try:
+            image_format = Image.registered_extensions()[ext]
+        except KeyError:
+            raise ValueError("unknown file extension: {}".format(ext))
+
+    buffer = io.BytesIO()
+    im.save(buffer, image_format, **options)
+    with open(new_name, 'wb') as f:
+        f.write(buffer.getbuffer())
+
+
+def open_image(pth_item_abs, width, height):
+    """
+    Open and fully decode a single image file.
+
+    :param pth_item_abs: str, absolute path of the image file
+    :param width: int, maximum x size of the resized image
+    :param height: int, maximum y size of the resized image
+    :return: PIL Image object, or the Status of the file if it could not be opened or decoded
+    """
+    logr.info("Image.open('%s')", pth_item_abs)
+    try:
+        image = Image.open(pth_item_abs)
+    except UnidentifiedImageError as e:
+        logr.info("File '%s' not image file: %s", pth_item_abs, e)
+        return Status.NOT_IMAGE
+    except Image.DecompressionBombError as e:
+        logr.error("File '%s' too large to open: %s", pth_item_abs, e)
+        return Status.NOT_IMAGE
+    except OSError as e:
+        logr.error("Unable to open file '%s' exception: %s", pth_item_abs, e)
+        return Status.NOT_IMAGE
+
+    # Let libjpeg downscale a JPEG by 1/2, 1/4 or 1/8 while decoding it, rather than decode every pixel
+    # only to throw most of them away in the resize. The draft box is in the image's stored orientation,
+    # so it is swapped for an image that reorient_image() will turn by 90 degrees. MPO images from cameras are JPEGs
+    # too. A zero constraint is left to fail in the resize.
+    if isinstance(image, JpegImagePlugin.JpegImageFile) and width > 0 and height > 0:
+        if get_orientation(image) in TRANSPOSED_ORIENTATIONS:
+            image.draft('RGB', (height, width))
         else:
-            return im
-    except (KeyError, AttributeError, TypeError, IndexError):
-        return im
+            image.draft('RGB', (width, height))
+
+    try:
+        image.load()
+    except Exception as e:
+        logr.error("Unable to decode file '%s' exception: %s", pth_item_abs, e)
+        image.close()
+        return Status.RESIZE_FAIL
+
+    return image
+
+
+def resize_image(task, image):
+    """
+    Reorient, resize and save a single decoded image.
+
+    :param task: tuple of (pth_item_abs, width, height, abs_subdir, filt), see resize_images()
+    :param image: PIL Image object returned by open_image(), the caller closes it
+    :return: Status of the image file
+    """
+    pth_item_abs, width, height, abs_subdir, filt = task
+
+    img_name = os.path.basename(pth_item_abs)
+    img_basename, ext = os.path.splitext(img_name)
+
+    size = image.size
+    img_x = size[0]
+    img_y = size[1]
+    logr.debug("Image Size: %d %d", img_x, img_y)
+
+    # Resize in the stored orientation and reorient afterwards, so that the transpose only copies the resized
+    # pixels. If reorienting turns the image by 90 degrees, fit the constraints to its turned size instead.
+    orientation = get_orientation(image)
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        new_y, new_x = determine_resize(width, height, img_y, img_x)
+    else:
+        new_x, new_y = determine_resize(width, height, img_x, img_y)
+    logr.debug("New Width: %d  New Height: %d", new_x, new_y)
+
+    # An image that already fits the constraints is saved as it is, resizing would only reproduce it
+    if (new_x, new_y) != (img_x, img_y):
+        try:
+            resized = image.resize((new_x, new_y), filt)
+        except Exception as e:
+            logr.error("Unable to resize file '%s' exception: %s", pth_item_abs, e)
+            return Status.RESIZE_FAIL
+
+        # Unlike the opened image, the resized and reoriented images have no file behind them to close
+        image = resized
+
+    image = reorient_image(image, orientation)
+
+    new_name = os.path.join(abs_subdir, img_name)
+
+    logr.info("Resized and saving image: '%s'", new_name)
+
+    try:
+        save_image(image, new_name)
+        # save_image(image, new_name, 'JPEG', quality=95)
+    except Exception as e:
+        logr.error("Unable to save '%s' exception: %s", new_name, e)
+
+        # If throw save exception, try and convert the image to JPG and then try and save it
+        logr.info("Attempt to convert %s image to JPG and save it...", ext)
+        try:
+            # JPEG can store RGB and L images as they are, only other modes need a conversion pass
+            if image.mode in ('RGB', 'L'):
+                rgb_img = image
+            else:
+                rgb_img = image.convert('RGB')
+        except Exception as e:
+            logr.error("Unable to convert image to JPG from %s after save failure, exception: %s", ext, e)
+            return Status.SAVE_FAIL
+
+        new_name = os.path.join(abs_subdir, img_basename + '.jpg')
+
+        logr.debug("Saving image: %s", new_name)
+        try:
+            save_image(rgb_img, new_name, 'JPEG', **JPEG_SAVE_OPTIONS)
+        except Exception as e:
+            logr.error("Unable to save '%s' after JPG conversion, exception: %s", new_name, e)
+        finally:
+            if rgb_img is not image:
+                rgb_img.close()
+
+        return Status.SAVE_FAIL
+
+    return Status.RESIZED
+
+
+def _resize_opened_image(task, image):
+    """
+    Resize and save an image returned by open_image() and then close it. An unexpected exception is logged and
+    counted as a resize failure, so one bad file cannot stop the rest of the batch.
+
+    :param task: tuple of (pth_item_abs, width, height, abs_subdir, filt), see resize_images()
+    :param image: PIL Image object, or the Status returned by open_image()
+    :return: Status of the image file
+    """
+    if isinstance(image, Status):
+        return image
+    try:
+        with image:
+            return resize_image(task, image)
+    except Exception:
+        logr.exception("Unexpected error resizing file '%s'", task[0])
+        return Status.RESIZE_FAIL
+
+
+def process_image(task):
+    """
+    Open, reorient, resize and save a single image file.
+
+    This is a top level function taking a single tuple so it can be handed to a process pool.
+
+    :param task: tuple of (pth_item_abs, width, height, abs_subdir, filt), see resize_images()
+    :return: Status of the image file
+    """
+    pth_item_abs, width, height = task[:3]
+    try:
+        image = open_image(pth_item_abs, width, height)
+    except Exception:
+        logr.exception("Unexpected error opening file '%s'", pth_item_abs)
+        return Status.RESIZE_FAIL
+    return _resize_opened_image(task, image)
+
+
+def _decode_ahead(tasks, decoded):
+    """
+    Producer thread of pipeline_images(), open and decode each task's image file onto the decoded queue.
+
+    :param tasks: list of process_image() task tuples
+    :param decoded: queue.Queue of (task, open_image() result) tuples, terminated by None, or by the exception
+        that stopped the producer early
+    :return: None
+    """
+    try:
+        for task in tasks:
+            pth_item_abs, width, height = task[:3]
+            try:
+                image = open_image(pth_item_abs, width, height)
+            except Exception:
+                # One bad file must not end the queue before the other files have been decoded
+                logr.exception("Unexpected error opening file '%s'", pth_item_abs)
+                image = Status.RESIZE_FAIL
+            decoded.put((task, image))
+    except BaseException as e:
+        decoded.put(e)
+    else:
+        decoded.put(None)
 
 
-def resize_images(path, width, height, test, subdir):
+def pipeline_images(tasks):
+    """
+    Run process_image() over all the tasks in this process, decoding the next images in a producer thread while
+    the current one is resized and saved. Pillow releases the GIL while it reads and decodes, so disk latency is
+    hidden behind the resize.
+
+    :param tasks: list of process_image() task tuples
+    :return: list of Status, one per task
+    """
+    # Bounded, so at most a few decoded images are held in memory at once
+    decoded = queue.Queue(maxsize=4)
+    producer = threading.Thread(target=_decode_ahead, args=(tasks, decoded), daemon=True)
+    producer.start()
+
+    statuses = []
+    while True:
+        item = decoded.get()
+        if item is None:
+            break
+        if isinstance(item, BaseException):
+            producer.join()
+            raise item
+        task, image = item
+        statuses.append(_resize_opened_image(task, image))
+
+    producer.join()
+    return statuses
+
+
+def _init_worker(log_queue, log_level):
+    """
+    Process pool initializer, forward the worker's birt log records to the parent process.
+
+    :param log_queue: multiprocessing.Queue drained by a QueueListener in the parent process
+    :param log_level: logging level of the parent's 'birt' logger
+    :return: None
+    """
+    logger = logging.getLogger('birt')
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(log_level)
+
+
+def process_images(tasks, jobs):
+    """
+    Run process_image() over all the tasks, in parallel over jobs worker processes.
+
+    Every file is independent of the others and the work is CPU bound, so a process pool (rather than threads,
+    which would contend for the GIL) scales with the number of cores.
+
+    :param tasks: list of process_image() task tuples
+    :param jobs: int, number of worker processes, 1 processes the tasks in this process with pipeline_images()
+    :return: list of Status, one per task
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        return pipeline_images(tasks)
+
+    logger = logging.getLogger('birt')
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                    initargs=(log_queue, logger.getEffectiveLevel())) as executor:
+            # Few enough chunks to keep the inter-process overhead down, enough to spread them over the workers
+            chunksize = max(1, len(tasks) // (4 * jobs))
+            return list(executor.map(process_image, tasks, chunksize=chunksize))
+    finally:
+        listener.stop()
+
+
+def resize_images(path, width, height, test, subdir, filt=FILTERS[DEFAULT_FILTER], jobs=None, recursive=False):
     """
     Resize and possible rename and/or relocate resized images.
 
@@ -113,8 +453,14 @@ def resize_images(path, width, height, test, subdir):
     :param height: int, maximum y size of resized images
     :param test: bool, if True only output what would be done, but don't do it
     :param subdir: PathObject, sub-directory to relocate resized images
+    :param filt: PIL resampling filter used to resize, one of the FILTERS values
+    :param jobs: int, number of worker processes, None uses one per CPU
+    :param recursive: bool, if True also resize images in the directories below path, mirroring them in subdir
     :return: None
     """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
     # Count Images Processed
     i = 0  # Total file count
     r = 0  # Resized file count
@@ -125,103 +471,69 @@ def resize_images(path, width, height, test, subdir):
     abspath = os.path.abspath(path)
 
     # If necessary create a sub-directory
-    abs_subdir = os.path.join(abspath, subdir)
-    if not os.path.exists(abs_subdir):
-        os.makedirs(abs_subdir)
-
-    path_contents = os.listdir(abspath)
-
-    for pth_item in path_contents:
-        logr.debug("="*80)
-        i = i + 1
-        logr.debug("Path Item {}: {}".format(i, pth_item))
-        pth_item_abs = os.path.join(abspath, pth_item)
-        if os.path.isfile(pth_item_abs):
-            logr.info("Image.open('{}')".format(pth_item_abs))
-            image = None
-            if not test:
-                try:
-                    image = Image.open(pth_item_abs)
-                except Exception as e:
-                    logr.info("File '{}' not image file: {}".format(pth_item_abs, e))
-                    nf = nf + 1
-                    continue
-
-                image = reorient_image(image)
-
-                file_path, ext = os.path.splitext(pth_item_abs)
-                img_path = os.path.dirname(file_path)
-                img_basename = os.path.basename(file_path)
-
-                size = image.size
-                img_x = size[0]
-                img_y = size[1]
-                logr.debug("Image Size: {} {}".format(img_x, img_y))
-
-                new_x, new_y = determine_resize(width, height, img_x, img_y)
-                logr.debug("New Width: {}  New Height: {}".format(new_x, new_y))
-
-                try:
-                    image = image.resize((new_x, new_y), Image.ANTIALIAS)
-                except Exception as e:
-                    logr.error("Unable to resize file '{}' exception: {}".format(pth_item_abs, e))
-                    image.close()
-                    rf = rf + 1
-                    continue
-
-                new_name = os.path.join(abs_subdir, img_basename) + ext
-
-                logr.info("Resized and saving image: '{}'".format(new_name))
-
-                try:
-                    image.save(new_name)
-                    # image.save(new_name, 'JPEG', quality=95)
-                except Exception as e:
-                    logr.error("Unable to save '{}' exception: {}".format(new_name, e))
-
-                    sf = sf + 1
-
-                    # If throw save exception, try and convert the image to JPG and then try and save it
-                    logr.info("Attempt to convert {} image to JPG and save it...".format(ext))
-                    try:
-                        rgb_img = image.convert('RGB')
-                    except Exception as e:
-                        logr.error("Unable to convert image to JPG from {} after save failure, exception: {}".format(ext, e))
-                        image.close()
-                        continue
-
-                    new_name = os.path.join(abs_subdir, img_basename) + '.jpg'
-
-                    logr.debug("Saving image: {}".format(new_name))
-                    try:
-                        rgb_img.save(new_name)
-                    except Exception as e:
-                        logr.error("Unable to save '{}' after JPG conversion, exception: {}".format(new_name, e))
-                        image.close()
-                        continue
-
-                    image.close()
-                    continue
-
-                r = r + 1
-
-            if not test:
-                if image:
-                    image.close()
-        else:
-            # Not a file
-            logr.debug("Not a file!")
-            d = d + 1
+    abs_subdir = os.path.normpath(os.path.join(abspath, subdir))
+    os.makedirs(abs_subdir, exist_ok=True)
+
+    # Checked once, rather than building debug messages for every entry only for logging to discard them
+    debug = logr.isEnabledFor(logging.DEBUG)
+
+    # Directories still to scan, only PATH itself unless recursive
+    pending = [abspath]
+
+    tasks = []
+    while pending:
+        root = pending.pop()
+        # Mirror the directory structure below PATH in the sub-directory
+        out_dir = os.path.normpath(os.path.join(abs_subdir, os.path.relpath(root, abspath)))
+        out_dir_exists = root == abspath
+
+        # os.scandir() returns each entry's file type along with its name, so is_file() doesn't need a stat() per
+        # entry
+        with os.scandir(root) as path_contents:
+            for entry in path_contents:
+                i = i + 1
+                if debug:
+                    logr.debug(SEPARATOR)
+                    logr.debug("Path Item %d: %s", i, entry.path)
+                if entry.is_file():
+                    ext = os.path.splitext(entry.name)[1].lower()
+                    if ext not in IMAGE_EXTENSIONS:
+                        logr.info("File '%s' not image file: unrecognized extension", entry.path)
+                        nf = nf + 1
+                    elif test:
+                        logr.info("Image.open('%s')", entry.path)
+                    else:
+                        if not out_dir_exists:
+                            os.makedirs(out_dir, exist_ok=True)
+                            out_dir_exists = True
+                        tasks.append((entry.path, width, height, out_dir, filt))
+                else:
+                    # Not a file, descend into it if it is a directory other than the one being written to
+                    if recursive and entry.is_dir(follow_symlinks=False) and entry.path != abs_subdir:
+                        pending.append(entry.path)
+                    if debug:
+                        logr.debug("Not a file!")
+                    d = d + 1
+
+    for status in process_images(tasks, jobs):
+        if status is Status.RESIZED:
+            r = r + 1
+        elif status is Status.NOT_IMAGE:
+            nf = nf + 1
+        elif status is Status.RESIZE_FAIL:
+            rf = rf + 1
+        elif status is Status.SAVE_FAIL:
+            sf = sf + 1
 
     T = r + d + nf + rf + sf
 
-    logr.info("Files Processed: {:>4}".format(i))
+    logr.info("Files Processed: %4d", i)
     logr.info("------------------------")
-    logr.info("        Resized: {:>4}".format(r))
-    logr.info("      Not files: {:>4}".format(d))
-    logr.info("     Not images: {:>4}".format(nf))
-    logr.info("   Resized Fail: {:>4}".format(rf))
-    logr.info("     Saved Fail: {:>4}".format(sf))
+    logr.info("        Resized: %4d", r)
+    logr.info("      Not files: %4d", d)
+    logr.info("     Not images: %4d", nf)
+    logr.info("   Resized Fail: %4d", rf)
+    logr.info("     Saved Fail: %4d", sf)
     logr.info("               ---------")
-    logr.info("          Total: {:>4}".format(T))
+    logr.info("          Total: %4d", T)
 
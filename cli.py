@@ -101,7 +101,12 @@ def setup_logging(level_ch):
 @click.option('--quiet', '-q', is_flag=True, help='Enable quiet output (--logging_level=ERROR)')
 @click.option('--logging-level', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], case_sensitive=True))
 @click.option('--test', '-t', is_flag=True, help='Test Mode, do not process images, just emit what would be done.')
-def cli(path, width, height, subdir, verbose, quiet, logging_level, test):
+@click.option('--filter', 'filter_name', type=click.Choice(list(birt.FILTERS), case_sensitive=False),
+              default=birt.DEFAULT_FILTER, help='Resampling filter, bicubic for speed or lanczos for quality. Default: "{}"'.format(birt.DEFAULT_FILTER))
+@click.option('--jobs', '-j', type=click.IntRange(min=1), metavar='N', default=None,
+              help='Resize images in N worker processes. Default: one per CPU')
+@click.option('--recursive', '-r', is_flag=True, help='Also resize images in the directories below PATH, mirroring them in SUBDIR.')
+def cli(path, width, height, subdir, verbose, quiet, logging_level, test, filter_name, jobs, recursive):
     """
     Resize images in PATH to a size that is limited to (WIDTH, HEIGHT).
 
@@ -114,7 +119,7 @@ def cli(path, width, height, subdir, verbose, quiet, logging_level, test):
 
     logr, console_handler, file_handler = setup_logging(logging_level)
 
-    logr.info("{} {}".format(IDENT, VERSION))
+    logr.info("%s %s", IDENT, VERSION)
 
     if verbose:
         console_handler.setLevel(LOGGING.DEBUG)
@@ -122,16 +127,19 @@ def cli(path, width, height, subdir, verbose, quiet, logging_level, test):
     if quiet:
         console_handler.setLevel(LOGGING.ERROR)
 
-    logr.debug('path: {}'.format(path))
-    logr.debug('width: {}'.format(width))
-    logr.debug('height: {}'.format(height))
-    logr.debug('subdir: {}'.format(subdir))
-    logr.debug('test: {}'.format(test))
-    logr.debug('logging_level: {}'.format(logging_level))
-    logr.debug('verbose: {}'.format(verbose))
+    logr.debug('path: %s', path)
+    logr.debug('width: %s', width)
+    logr.debug('height: %s', height)
+    logr.debug('subdir: %s', subdir)
+    logr.debug('test: %s', test)
+    logr.debug('logging_level: %s', logging_level)
+    logr.debug('verbose: %s', verbose)
+    logr.debug('filter: %s', filter_name)
+    logr.debug('jobs: %s', jobs)
+    logr.debug('recursive: %s', recursive)
 
     # Call the birt module's resize function
-    birt.resize_images(path, width, height, test, subdir)
+    birt.resize_images(path, width, height, test, subdir, birt.FILTERS[filter_name.lower()], jobs, recursive)
 
 
 if __name__ == '__main__':
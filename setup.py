@@ -1,14 +1,25 @@
+import os
+
 from setuptools import setup
 
 from version import VERSION
 
+# Pillow-SIMD is a drop-in replacement for Pillow that installs the same PIL package, so the two cannot be
+# installed side by side (which rules out an extras_require). Set BIRT_PILLOW_SIMD=1 to depend on Pillow-SIMD
+# instead; see the README for building it with AVX2 enabled. The Pillow wheels already bundle libjpeg-turbo, a
+# source build (such as Pillow-SIMD) needs the system's libjpeg-turbo development package, also see the README.
+if os.environ.get('BIRT_PILLOW_SIMD'):
+    PILLOW = 'Pillow-SIMD>=9.0.0.post1'
+else:
+    PILLOW = 'Pillow'
+
 setup(
     name='birt',
     version=VERSION,
     py_modules=['birt', 'cli', 'version'],
     install_requires=[
         'Click',
-        'Pillow',
+        PILLOW,
     ],
     entry_points={
         'console_scripts': [